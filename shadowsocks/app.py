@@ -5,7 +5,6 @@ import os
 import signal
 
 import sentry_sdk
-import uvloop
 from aiohttp import web
 from grpclib.events import RecvRequest, listen
 from grpclib.server import Server
@@ -13,9 +12,15 @@ from prometheus_async import aio
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 
 from shadowsocks.mdb import BaseModel, models
+from shadowsocks.metrics import FLUSH_INTERVAL, flush_batched_metrics
 from shadowsocks.proxyman import ProxyMan
 from shadowsocks.services import AioShadowsocksServicer
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 async def logging_grpc_request(event: RecvRequest) -> None:
     logging.info(f"{event.method_name} called!")
@@ -24,7 +29,7 @@ async def logging_grpc_request(event: RecvRequest) -> None:
 class App:
     def __init__(self, debug=False):
         self.debug = debug
-        if not self.debug:
+        if not self.debug and uvloop:
             uvloop.install()
 
         self.loop = asyncio.get_event_loop()
@@ -117,10 +122,15 @@ class App:
         await runner.setup()
         self.metrics_server = web.TCPSite(runner, "0.0.0.0", self.metrics_port)
         await self.metrics_server.start()
+        self.flush_metrics()
         logging.info(
             f"Start Metrics Server At: http://0.0.0.0:{self.metrics_port}/metrics"
         )
 
+    def flush_metrics(self):
+        flush_batched_metrics()
+        self.loop.call_later(FLUSH_INTERVAL, self.flush_metrics)
+
     def run(self):
 
         if self.use_json:
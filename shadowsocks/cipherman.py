@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import time
 
@@ -164,6 +165,24 @@ class CipherMan:
         else:
             return self.cipher_cls(self.access_user.password).unpack(data)
 
+    @property
+    def offloadable(self) -> bool:
+        """tcp连接的cipher初始化之后, 加解密可以放到线程池里执行"""
+        return self.ts_protocol == flag.TRANSPORT_TCP and self.cipher is not None
+
+    async def encrypt_in_executor(self, data: bytes, executor):
+        # NOTE 流量统计会写数据库, 必须留在事件循环所在的线程
+        self.record_user_traffic(0, len(data))
+        loop = asyncio.get_running_loop()
+        with ENCRYPT_DATA_TIME.time():
+            return await loop.run_in_executor(executor, self.cipher.encrypt, data)
+
+    async def decrypt_in_executor(self, data: bytes, executor):
+        self.record_user_traffic(len(data), 0)
+        loop = asyncio.get_running_loop()
+        with DECRYPT_DATA_TIME.time():
+            return await loop.run_in_executor(executor, self.cipher.decrypt, data)
+
     def incr_user_tcp_num(self, num: int):
         self.access_user and self.access_user.incr_tcp_conn_num(num)
 
@@ -85,7 +85,7 @@ class BaseStreamCipher(BaseCipher, metaclass=abc.ABCMeta):
 
     def decrypt(self, data: bytes):
         if not self.decrypt_func:
-            iv, data = data[: self.IV_SIZE], data[self.IV_SIZE :]
+            iv, data = bytes(data[: self.IV_SIZE]), data[self.IV_SIZE :]
             self.decrypt_func = self._init_decrypt_func(iv)
         return self.decrypt_func(data)
 
@@ -148,23 +148,23 @@ class BaseAEADCipher(BaseCipher):
         return decrypt
 
     def encrypt(self, data: bytes):
-        ret = bytearray()
+        # NOTE 先收集各个分片, 最后只做一次拼接, 避免整帧的中间拷贝
+        ret = []
         if not self.encrypt_func:
             salt, self.encrypt_func = self._init_encrypt_func(None)
-            ret.extend(salt)
+            ret.append(salt)
 
         for i in range(0, len(data), self.PACKET_LIMIT):
             buf = data[i : i + self.PACKET_LIMIT]
-            len_chunk, len_tag = self.encrypt_func(len(buf).to_bytes(2, "big"))
-            body_chunk, body_tag = self.encrypt_func(buf)
-            ret.extend(len_chunk + len_tag + body_chunk + body_tag)
+            ret.extend(self.encrypt_func(len(buf).to_bytes(2, "big")))
+            ret.extend(self.encrypt_func(buf))
 
-        return bytes(ret)
+        return b"".join(ret)
 
     def decrypt(self, data: bytes):
-        ret = bytearray()
+        ret = []
         if not self.decrypt_func:
-            salt, data = data[: self.SALT_SIZE], data[self.SALT_SIZE :]
+            salt, data = bytes(data[: self.SALT_SIZE]), data[self.SALT_SIZE :]
             self.decrypt_func = self._init_decrypt_func(salt)
 
         self._buffer.extend(data)
@@ -188,7 +188,7 @@ class BaseAEADCipher(BaseCipher):
             else:
                 if len(self._buffer) < self._payload_len + self.TAG_SIZE:
                     break
-                ret.extend(
+                ret.append(
                     self.decrypt_func(
                         self._buffer[: self._payload_len],
                         self._buffer[
@@ -199,7 +199,7 @@ class BaseAEADCipher(BaseCipher):
                 del self._buffer[: self._payload_len + self.TAG_SIZE]
                 self._payload_len = None
 
-        return bytes(ret)
+        return b"".join(ret)
 
     def unpack(self, data: bytes) -> bytes:
         """解包udp"""
@@ -216,13 +216,9 @@ class BaseAEADCipher(BaseCipher):
 
     def pack(self, data: bytes) -> bytes:
         """压udp包"""
-        ret = bytearray()
         salt, encrypt_func = self._init_encrypt_func(None)
-        ret.extend(salt)
         chunk, tag = encrypt_func(data)
-        ret.extend(chunk)
-        ret.extend(tag)
-        return bytes(ret)
+        return b"".join((salt, chunk, tag))
 
     @classmethod
     def tcp_first_data_len(cls):
@@ -244,13 +240,14 @@ class NONE(BaseStreamCipher):
 
     def _init_encrypt_func(self):
         def encrypt(plaintext: bytes) -> bytes:
-            return plaintext
+            # NOTE 传进来的可能是复用buffer的memoryview,需要拷贝一份出去
+            return bytes(plaintext)
 
         return encrypt
 
     def _init_decrypt_func(self, iv: bytes):
         def decrypt(ciphertext: bytes) -> bytes:
-            return ciphertext
+            return bytes(ciphertext)
 
         return decrypt
 
@@ -1,12 +1,100 @@
 import asyncio
 import logging
+import os
 import socket
 import struct
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from shadowsocks import protocol_flag as flag
 from shadowsocks.cipherman import CipherMan
 from shadowsocks.metrics import ACTIVE_CONNECTION_COUNT, CONNECTION_MADE_COUNT
-from shadowsocks.utils import parse_header
+from shadowsocks.utils import get_ip_from_domain, parse_header
+
+READ_BUFFER_SIZE = 64 * 1024
+CRYPTO_OFFLOAD_SIZE = 16 * 1024
+CRYPTO_QUEUE_HIGH_WATER = 1024 * 1024
+CRYPTO_QUEUE_LOW_WATER = 256 * 1024
+UDP_MAX_PEERS = 1024
+MAX_PRECONNECT_BYTES = 256 * 1024
+
+# NOTE udp回包在事件循环里同步加密, 所有RemoteUDP共用一块buffer拼装报文
+_udp_reply_buf = bytearray(64 * 1024 + 32)
+
+
+def _noop(data):
+    pass
+
+
+crypto_executor = ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="crypto"
+)
+
+
+class CryptoQueue:
+    """
+    大包的加解密放到线程池里执行, 避免阻塞事件循环上的其他连接
+
+    一旦有数据在排队, 后续的小包也要进队列, 保证同一条连接上的数据顺序
+    排队的数据超过高水位时调用pause暂停数据来源, 降到低水位以下再调用resume恢复
+    """
+
+    def __init__(self, crypto_func, callback, errback, pause, resume):
+        self._crypto_func = crypto_func
+        self._callback = callback
+        self._errback = errback
+        self._pause = pause
+        self._resume = resume
+        self._pending = None
+        self._pending_size = 0
+        self._paused = False
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        self._pending = None
+        self._pending_size = 0
+
+    def feed(self, data) -> bool:
+        """返回False表示数据没有入队, 由调用方直接在事件循环里处理"""
+        if self._closed:
+            # NOTE 连接已经关闭, 数据直接丢掉
+            return True
+        if self._pending is None:
+            if len(data) < CRYPTO_OFFLOAD_SIZE:
+                return False
+            self._pending = deque()
+            asyncio.create_task(self._drain())
+        # NOTE data可能是复用buffer的memoryview, 入队前必须拷贝
+        data = bytes(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if not self._paused and self._pending_size > CRYPTO_QUEUE_HIGH_WATER:
+            self._paused = True
+            self._pause()
+        return True
+
+    async def _drain(self):
+        while self._pending:
+            data = self._pending.popleft()
+            self._pending_size -= len(data)
+            if self._paused and self._pending_size <= CRYPTO_QUEUE_LOW_WATER:
+                self._paused = False
+                self._resume()
+            try:
+                data = await self._crypto_func(data, crypto_executor)
+            except Exception as e:
+                if not self._closed:
+                    self._pending = None
+                    self._pending_size = 0
+                    self._errback(e)
+                return
+            if self._closed:
+                return
+            if data:
+                self._callback(data)
+        self._pending = None
 
 
 class LocalHandler:
@@ -26,6 +114,31 @@ class LocalHandler:
     STAGE_DESTROY = -1
     STAGE_ERROR = 255
 
+    # 每个状态下收到数据的处理方法, 切换状态时绑定到 self._on_data
+    STAGE_HANDLERS = {
+        STAGE_INIT: "_on_data_init",
+        STAGE_CONNECT: "_handle_stage_connect",
+        STAGE_STREAM: "_handle_stage_stream",
+        STAGE_DESTROY: "_on_data_dead",
+        STAGE_ERROR: "_on_data_dead",
+    }
+
+    __slots__ = (
+        "port",
+        "cipher",
+        "write",
+        "_stage",
+        "_on_data",
+        "_peername",
+        "_remote",
+        "_transport",
+        "_transport_protocol",
+        "_is_closing",
+        "_connect_buffer",
+        "_preconnect_size",
+        "_decrypt_queue",
+    )
+
     def __init__(self, port):
         super().__init__()
 
@@ -33,47 +146,58 @@ class LocalHandler:
         self.cipher = None
 
         self._stage = None
+        self._on_data = None
         self._peername = None
         self._remote = None
         self._transport = None
         self._transport_protocol = None
-        self._transport_protocol_human = None
         self._is_closing = False
-        self._connect_buffer = bytearray()
+        self._connect_buffer = []
+        self._preconnect_size = 0
+        self._decrypt_queue = None
+
+    def _set_stage(self, stage):
+        self._stage = stage
+        self._on_data = getattr(self, self.STAGE_HANDLERS[stage])
 
     def _init_transport(self, transport: asyncio.Transport, peername, protocol):
-        self._stage = self.STAGE_INIT
+        self._set_stage(self.STAGE_INIT)
         self._transport = transport
         self._peername = peername
         self._transport_protocol = protocol
+        # NOTE 协议在连接建立时就确定了, 直接绑定对应的写方法
         if protocol == flag.TRANSPORT_TCP:
-            self._transport_protocol_human = "tcp"
+            self.write = transport.write
         else:
-            self._transport_protocol_human = "udp"
+            self.write = partial(transport.sendto, addr=peername)
 
     def _init_cipher(self):
         self.cipher = CipherMan.get_cipher_by_port(self.port, self._transport_protocol)
+        if self._transport_protocol == flag.TRANSPORT_TCP:
+            self._decrypt_queue = CryptoQueue(
+                self.cipher.decrypt_in_executor,
+                lambda data: self._on_data(data),
+                self._handle_decrypt_error,
+                self._transport.pause_reading,
+                self._transport.resume_reading,
+            )
 
     def close(self):
-        self._stage = self.STAGE_DESTROY
+        self._set_stage(self.STAGE_DESTROY)
         if self._is_closing:
             return
         self._is_closing = True
-        ACTIVE_CONNECTION_COUNT.inc(-1)
+        # NOTE 关闭之后的数据直接丢掉
+        self.write = _noop
+        self._connect_buffer = None
+        self._decrypt_queue and self._decrypt_queue.close()
 
         if self._transport_protocol == flag.TRANSPORT_TCP:
+            ACTIVE_CONNECTION_COUNT.inc(-1)
             self._transport and self._transport.close()
             self.cipher and self.cipher.incr_user_tcp_num(-1)
         self._remote and self._remote.close()
 
-    def write(self, data):
-        if self._transport_protocol == flag.TRANSPORT_TCP:
-            if self._transport.is_closing():
-                return
-            self._transport.write(data)
-        else:
-            self._transport.sendto(data, self._peername)
-
     def handle_connection_made(self, transport_protocol, transport, peername):
         self._init_transport(transport, peername, transport_protocol)
         self._init_cipher()
@@ -85,31 +209,30 @@ class LocalHandler:
         self.close()
 
     def handle_data_received(self, data):
+        if self.cipher.offloadable and self._decrypt_queue.feed(data):
+            return
 
         try:
             data = self.cipher.decrypt(data)
         except Exception as e:
-            self.close()
-            logging.warning(
-                f"decrypt data error:{e} remote:{self._peername},type:{self._transport_protocol_human} closing..."
-            )
+            self._handle_decrypt_error(e)
             return
 
-        if not data:
-            return
+        if data:
+            self._on_data(data)
 
-        if self._stage == self.STAGE_INIT:
-            asyncio.create_task(self._handle_stage_init(data))
-        elif self._stage == self.STAGE_CONNECT:
-            self._handle_stage_connect(data)
-        elif self._stage == self.STAGE_STREAM:
-            self._handle_stage_stream(data)
-        elif self._stage == self.STAGE_ERROR:
-            self.close()
-        elif self._stage == self.STAGE_DESTROY:
-            self.close()
-        else:
-            logging.warning(f"unknown stage:{self._stage}")
+    def _handle_decrypt_error(self, e):
+        self.close()
+        ts_type = "tcp" if self._transport_protocol == flag.TRANSPORT_TCP else "udp"
+        logging.warning(
+            f"decrypt data error:{e} remote:{self._peername},type:{ts_type} closing..."
+        )
+
+    def _on_data_init(self, data):
+        asyncio.create_task(self._handle_stage_init(data))
+
+    def _on_data_dead(self, data):
+        self.close()
 
     async def _handle_stage_init(self, data):
         addr_type, dst_addr, dst_port, header_length = parse_header(data)
@@ -119,23 +242,33 @@ class LocalHandler:
             return
         else:
             payload = data[header_length:]
+
+        if self._transport_protocol == flag.TRANSPORT_TCP:
+            # NOTE 在dns解析之前就进入CONNECT阶段, 解析和建连期间收到的数据都先缓存起来
+            self._set_stage(self.STAGE_CONNECT)
+            self._handle_stage_connect(payload)
+
+        if addr_type == flag.ATYPE_DOMAINNAME:
+            dst_addr = await get_ip_from_domain(dst_addr)
+            if self._is_closing:
+                return
         logging.debug(
             f"HEADER: {addr_type} - {dst_addr} - {dst_port} - {self._transport_protocol}"
         )
 
         loop = asyncio.get_running_loop()
         if self._transport_protocol == flag.TRANSPORT_TCP:
-            self._stage = self.STAGE_CONNECT
-            self._handle_stage_connect(payload)
             try:
                 _, remote_tcp = await loop.create_connection(
                     lambda: RemoteTCP(self), dst_addr, dst_port
                 )
             except Exception as e:
-                self._stage = self.STAGE_ERROR
+                self._set_stage(self.STAGE_ERROR)
                 self.close()
                 logging.warning(f"connection failed, {type(e)} e: {e}")
             else:
+                if self._is_closing:
+                    return
                 self._remote = remote_tcp
                 self.cipher.record_user_ip(self._peername)
         else:
@@ -145,16 +278,24 @@ class LocalHandler:
                     remote_addr=(dst_addr, dst_port),
                 )
             except Exception as e:
-                self._stage = self.STAGE_ERROR
+                self._set_stage(self.STAGE_ERROR)
                 self.close()
                 logging.warning(f"connection failed, {type(e)} e: {e}")
 
     def _handle_stage_connect(self, data):
         # 在握手之后，会耗费一定时间来来和remote建立连接,但是ss-client并不会等这个时间
         if not self._remote or self._remote.ready == False:
-            self._connect_buffer.extend(data)
+            self._preconnect_size += len(data)
+            if self._preconnect_size > MAX_PRECONNECT_BYTES:
+                logging.warning(
+                    f"too much data before remote ready, remote:{self._peername} closing..."
+                )
+                self.close()
+                return
+            self._connect_buffer.append(data)
         else:
-            self._stage = self.STAGE_STREAM
+            self._connect_buffer = None
+            self._set_stage(self.STAGE_STREAM)
             self._handle_stage_stream(data)
 
     def _handle_stage_stream(self, data):
@@ -162,28 +303,38 @@ class LocalHandler:
         logging.debug(f"relay data length {len(data)}")
 
 
-class LocalTCP(asyncio.Protocol):
+class BufferedTCP(asyncio.BufferedProtocol):
     """
-    Local Tcp Factory
+    复用同一块bytearray来接收数据,避免每次读都新分配一个bytes
+
+    NOTE 子类在buffer_updated里拿到的是memoryview,只在回调内有效,需要保留的数据必须拷贝
     """
 
-    def __init__(self, port):
-        self.port = port
-        self._handler = None
+    _buf = None
+    _view = None
 
-    def _init_handler(self):
-        self._handler = LocalHandler(self.port)
+    def get_buffer(self, sizehint):
+        if self._buf is None or sizehint > len(self._buf):
+            self._buf = bytearray(max(sizehint, READ_BUFFER_SIZE))
+            self._view = memoryview(self._buf)
+        return self._view
 
-    def __call__(self):
-        local = LocalTCP(self.port)
-        local._init_handler()
-        return local
+
+class LocalTCP(BufferedTCP):
+    """
+    Local Tcp Protocol
+    每个accept的连接一个实例, 用 partial(LocalTCP, port) 作为工厂
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._handler = LocalHandler(port)
 
     def pause_writing(self):
-        self._handler._remote._transport.pause_reading()
+        self._handler._remote.pause_reading_for_downstream()
 
     def resume_writing(self):
-        self._handler._remote._transport.resume_reading()
+        self._handler._remote.resume_reading_for_downstream()
 
     def connection_made(self, transport):
         self._transport = transport
@@ -192,8 +343,9 @@ class LocalTCP(asyncio.Protocol):
         CONNECTION_MADE_COUNT.inc()
         ACTIVE_CONNECTION_COUNT.inc()
 
-    def data_received(self, data):
-        self._handler.handle_data_received(data)
+    def buffer_updated(self, nbytes):
+        # NOTE 直接交给handler, 省掉一层data_received的调用
+        self._handler.handle_data_received(self._view[:nbytes])
 
     def eof_received(self):
         self._handler.handle_eof_received()
@@ -202,26 +354,29 @@ class LocalTCP(asyncio.Protocol):
         self._handler.handle_connection_lost(exc)
 
 
-class RemoteTCP(asyncio.Protocol):
+class RemoteTCP(BufferedTCP):
     def __init__(self, local_handler):
         super().__init__()
 
         self.local = local_handler
         self.peername = None
         self._transport = None
-        self.cipher = CipherMan(access_user=local_handler.cipher.access_user)
+        # NOTE cipher的加密和解密状态是分开的, 直接复用local的cipher
+        self.cipher = local_handler.cipher
         self.ready = False
+        self._encrypt_queue = None
+        # NOTE 读暂停有两个来源: 加密队列积压 和 local的写缓冲满了, 都解除才恢复读
+        self._queue_paused = False
+        self._downstream_paused = False
 
         self._is_closing = False
 
-    def write(self, data):
-        if not self._transport.is_closing():
-            self._transport.write(data)
-
     def close(self):
         if self._is_closing:
             return
         self._is_closing = True
+        self.write = _noop
+        self._encrypt_queue and self._encrypt_queue.close()
         ACTIVE_CONNECTION_COUNT.inc(-1)
 
         self._transport and self._transport.close()
@@ -229,15 +384,66 @@ class RemoteTCP(asyncio.Protocol):
 
     def connection_made(self, transport: asyncio.Transport):
         self._transport = transport
+        if self.local._is_closing:
+            # NOTE local在remote连上之前已经关闭了, 缓存的数据不再发送, 直接断开
+            self._is_closing = True
+            self.write = _noop
+            transport.close()
+            return
+        self.write = transport.write
+        self._encrypt_queue = CryptoQueue(
+            self.cipher.encrypt_in_executor,
+            lambda data: self.local.write(data),
+            self._handle_encrypt_error,
+            self.pause_reading_for_queue,
+            self.resume_reading_for_queue,
+        )
         self.peername = self._transport.get_extra_info("peername")
-        transport.write(self.local._connect_buffer)
+        # NOTE create_connection返回之前local可能又收到数据,提前挂上remote保证后续数据直接走stream
+        self.local._remote = self
+        buf, self.local._connect_buffer = self.local._connect_buffer, None
+        if buf:
+            transport.write(b"".join(buf))
         self.ready = True
         CONNECTION_MADE_COUNT.inc()
         ACTIVE_CONNECTION_COUNT.inc()
 
+    def buffer_updated(self, nbytes):
+        self.data_received(self._view[:nbytes])
+
     def data_received(self, data):
+        if self.cipher.offloadable and self._encrypt_queue.feed(data):
+            return
         self.local.write(self.cipher.encrypt(data))
 
+    def _update_reading(self):
+        if self._is_closing:
+            return
+        if self._queue_paused or self._downstream_paused:
+            self._transport.pause_reading()
+        else:
+            self._transport.resume_reading()
+
+    def pause_reading_for_queue(self):
+        self._queue_paused = True
+        self._update_reading()
+
+    def resume_reading_for_queue(self):
+        self._queue_paused = False
+        self._update_reading()
+
+    def pause_reading_for_downstream(self):
+        self._downstream_paused = True
+        self._update_reading()
+
+    def resume_reading_for_downstream(self):
+        self._downstream_paused = False
+        self._update_reading()
+
+    def _handle_encrypt_error(self, e):
+        self.close()
+        logging.warning(f"encrypt data error:{e} remote:{self.peername} closing...")
+
     def pause_reading(self):
         self.local._transport.pause_reading()
 
@@ -253,25 +459,28 @@ class RemoteTCP(asyncio.Protocol):
 
 class LocalUDP(asyncio.DatagramProtocol):
     """
-    Local Udp Factory
+    Local Udp Protocol
+    每个端口一个实例, 用 partial(LocalUDP, port) 作为工厂
     """
 
     def __init__(self, port):
         self.port = port
-        self._protocols = {}
+        self._protocols = OrderedDict()
         self._transport = None
 
-    def __call__(self):
-        local = LocalUDP(self.port)
-        return local
-
     def connection_made(self, transport):
         self._transport = transport
 
     def datagram_received(self, data, peername):
-        if peername in self._protocols:
-            handler = self._protocols[peername]
+        handler = self._protocols.get(peername)
+        if handler:
+            self._protocols.move_to_end(peername)
         else:
+            if len(self._protocols) >= UDP_MAX_PEERS:
+                # NOTE 按LRU淘汰最久没有收到数据的peer, 只是限制这张表的大小
+                # udp的handler没有持有任何remote endpoint, close只会把它标记为关闭
+                _, expired = self._protocols.popitem(last=False)
+                expired.close()
             handler = LocalHandler(self.port)
             self._protocols[peername] = handler
             handler.handle_connection_made(
@@ -291,15 +500,9 @@ class RemoteUDP(asyncio.DatagramProtocol):
         self.local = local_hander
         self.peername = None
         self._transport = None
-        self.cipher = CipherMan(
-            access_user=self.local.cipher.access_user, ts_protocol=flag.TRANSPORT_UDP
-        )
+        self.cipher = self.local.cipher
         self._is_closing = False
-
-    def write(self, data):
-        self._transport and not self._transport.is_closing() and self._transport.sendto(
-            data
-        )
+        self._reply_hdr = None
 
     def close(self):
         if self._is_closing:
@@ -311,26 +514,28 @@ class RemoteUDP(asyncio.DatagramProtocol):
 
     def connection_made(self, transport):
         self._transport = transport
+        self.write = transport.sendto
         self.peername = self._transport.get_extra_info("peername")
+        # 源地址和端口在endpoint的生命周期内不变, 返回的报文头只需构造一次
+        bind_addr, bind_port = self.peername[:2]
+        if ":" in bind_addr:
+            family, atype = socket.AF_INET6, flag.ATYPE_IPV6
+        else:
+            family, atype = socket.AF_INET, flag.ATYPE_IPV4
+        self._reply_hdr = (
+            bytes((atype,))
+            + socket.inet_pton(family, bind_addr)
+            + struct.pack("!H", bind_port)
+        )
         self.write(self.data)
 
     def datagram_received(self, data, peername, *arg):
-
         assert self.peername == peername
-        # 源地址和端口
-        bind_addr = peername[0]
-        bind_port = peername[1]
-        if "." in bind_addr:
-            addr = socket.inet_pton(socket.AF_INET, bind_addr)
-        elif ":" in bind_addr:
-            addr = socket.inet_pton(socket.AF_INET6, bind_addr)
-        else:
-            raise Exception("add not valid")
-        port = struct.pack("!H", bind_port)
-        # 构造返回的报文结构
-        data = b"\x01" + addr + port + data
-        data = self.cipher.encrypt(data)
-        self.local.write(data)
+        hdr_len = len(self._reply_hdr)
+        data_len = hdr_len + len(data)
+        _udp_reply_buf[:hdr_len] = self._reply_hdr
+        _udp_reply_buf[hdr_len:data_len] = data
+        self.local.write(self.cipher.encrypt(memoryview(_udp_reply_buf)[:data_len]))
 
     def error_received(self, exc):
         self.close()
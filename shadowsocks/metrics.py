@@ -4,6 +4,27 @@ from prometheus_client import Counter, Gauge, Histogram, Info
 
 # METRICS
 NODE_HOST_NAME = socket.gethostname()
+FLUSH_INTERVAL = 1
+
+
+class BatchedMetric:
+    """
+    先在内存里累加增量, 定时写入prometheus
+    避免每次连接/每个包都去拿metric的锁
+    """
+
+    def __init__(self, metric):
+        self._metric = metric
+        self._delta = 0
+
+    def inc(self, amount=1):
+        self._delta += amount
+
+    def flush(self):
+        if self._delta:
+            delta, self._delta = self._delta, 0
+            self._metric.inc(delta)
+
 
 SS_NODE_INFO = Info("ss_node", "ss node info")
 SS_NODE_INFO.info({"ss_node_name": NODE_HOST_NAME})
@@ -13,7 +34,9 @@ CONNECTION_MADE_COUNT = Counter(
     "shadowsocks connection made number",
     labelnames=["ss_node",],
 )
-CONNECTION_MADE_COUNT = CONNECTION_MADE_COUNT.labels(ss_node=NODE_HOST_NAME)
+CONNECTION_MADE_COUNT = BatchedMetric(
+    CONNECTION_MADE_COUNT.labels(ss_node=NODE_HOST_NAME)
+)
 
 
 ACTIVE_CONNECTION_COUNT = Gauge(
@@ -21,7 +44,9 @@ ACTIVE_CONNECTION_COUNT = Gauge(
     "shadowsocks active connection count",
     labelnames=["ss_node",],
 )
-ACTIVE_CONNECTION_COUNT = ACTIVE_CONNECTION_COUNT.labels(ss_node=NODE_HOST_NAME)
+ACTIVE_CONNECTION_COUNT = BatchedMetric(
+    ACTIVE_CONNECTION_COUNT.labels(ss_node=NODE_HOST_NAME)
+)
 
 
 NETWORK_TRANSMIT_BYTES = Counter(
@@ -29,7 +54,9 @@ NETWORK_TRANSMIT_BYTES = Counter(
     "shadowsocks network transmit bytes",
     labelnames=["ss_node",],
 )
-NETWORK_TRANSMIT_BYTES = NETWORK_TRANSMIT_BYTES.labels(ss_node=NODE_HOST_NAME)
+NETWORK_TRANSMIT_BYTES = BatchedMetric(
+    NETWORK_TRANSMIT_BYTES.labels(ss_node=NODE_HOST_NAME)
+)
 
 
 ENCRYPT_DATA_TIME = Histogram(
@@ -52,3 +79,15 @@ FIND_ACCESS_USER_TIME = Histogram(
     "find_access_user_time_seconds", "time to find access user", labelnames=["ss_node",]
 )
 FIND_ACCESS_USER_TIME = FIND_ACCESS_USER_TIME.labels(ss_node=NODE_HOST_NAME)
+
+
+BATCHED_METRICS = [
+    CONNECTION_MADE_COUNT,
+    ACTIVE_CONNECTION_COUNT,
+    NETWORK_TRANSMIT_BYTES,
+]
+
+
+def flush_batched_metrics():
+    for metric in BATCHED_METRICS:
+        metric.flush()
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 from collections import defaultdict
+from functools import partial
 
 from shadowsocks.core import LocalTCP, LocalUDP
 from shadowsocks.mdb.models import User
@@ -63,10 +64,10 @@ class ProxyMan:
             return
 
         tcp_server = await self.loop.create_server(
-            LocalTCP(user.port), self.listen_host, user.port
+            partial(LocalTCP, user.port), self.listen_host, user.port
         )
         udp_server, _ = await self.loop.create_datagram_endpoint(
-            LocalUDP(user.port), (self.listen_host, user.port)
+            partial(LocalUDP, user.port), (self.listen_host, user.port)
         )
         self.__running_servers__[user.port] = {
             "tcp": tcp_server,
@@ -1,7 +1,9 @@
+import asyncio
 import logging
 import socket
 import struct
-from functools import lru_cache
+import time
+from collections import OrderedDict
 
 from bloom_filter import BloomFilter
 
@@ -15,51 +17,65 @@ def is_stream_domain(domain):
     return False
 
 
-def logging_cahce_info():
-    def wrapper(func):
-        def decorated(*args, **kwargs):
-            logging.debug(f"domain:{args[0]} cache_info: {func.cache_info()}")
-            return func(*args, **kwargs)
+DNS_CACHE_TTL = 60
+DNS_CACHE_SIZE = 4096
 
-        return decorated
+# {domain: (expire_at, ip)}
+_dns_cache = OrderedDict()
 
-    return wrapper
 
+async def get_ip_from_domain(domain):
+    now = time.monotonic()
+    cached = _dns_cache.get(domain)
+    if cached and cached[0] > now:
+        return cached[1]
 
-@logging_cahce_info()
-@lru_cache(2 ** 8)
-def get_ip_from_domain(domain):
+    loop = asyncio.get_running_loop()
     try:
-        return socket.gethostbyname(domain.encode())
+        infos = await loop.getaddrinfo(
+            domain, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+        )
+        ip = infos[0][4][0]
     except Exception:
         logging.warning(f"Failed to query DNS: {domain}")
         return domain
 
+    _dns_cache.pop(domain, None)
+    if len(_dns_cache) >= DNS_CACHE_SIZE:
+        _dns_cache.popitem(last=False)
+    _dns_cache[domain] = (now + DNS_CACHE_TTL, ip)
+    logging.debug(f"domain:{domain} ip:{ip} dns cache size: {len(_dns_cache)}")
+    return ip
+
+
+PORT_STRUCT = struct.Struct("!H")
+
 
 def parse_header(data):
     # shadowsocks protocol https://shadowsocks.org/en/spec/Protocol.html
     atype, dst_addr, dst_port, header_length = data[0], None, None, 0
+    data_len = len(data)
     if atype == flag.ATYPE_IPV4:
-        if len(data) >= 7:
+        if data_len >= 7:
             dst_addr = socket.inet_ntop(socket.AF_INET, data[1:5])
-            dst_port = struct.unpack("!H", data[5:7])[0]
+            dst_port = PORT_STRUCT.unpack_from(data, 5)[0]
             header_length = 7
         else:
             logging.warning("header is too short")
     elif atype == flag.ATYPE_IPV6:
-        if len(data) >= 19:
+        if data_len >= 19:
             dst_addr = socket.inet_ntop(socket.AF_INET6, data[1:17])
-            dst_port = struct.unpack("!H", data[17:19])[0]
+            dst_port = PORT_STRUCT.unpack_from(data, 17)[0]
             header_length = 19
         else:
             logging.warning("header is too short")
     elif atype == flag.ATYPE_DOMAINNAME:
-        if len(data) > 2:
+        if data_len > 2:
             addrlen = data[1]
-            if len(data) >= 4 + addrlen:
-                dst_addr = data[2 : 2 + addrlen]
-                dst_addr = get_ip_from_domain(dst_addr.decode())
-                dst_port = struct.unpack("!H", data[2 + addrlen : addrlen + 4])[0]
+            if data_len >= 4 + addrlen:
+                # NOTE 域名在这里不做解析, 由调用方异步查询
+                dst_addr = data[2 : 2 + addrlen].decode()
+                dst_port = PORT_STRUCT.unpack_from(data, 2 + addrlen)[0]
                 header_length = 4 + addrlen
             else:
                 logging.warning("header is too short")
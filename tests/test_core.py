@@ -0,0 +1,377 @@
+import asyncio
+import socket
+import types
+
+from shadowsocks import core
+from shadowsocks.core import CryptoQueue
+
+BIG = core.CRYPTO_OFFLOAD_SIZE
+
+
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+        self.pause_count = 0
+        self.resume_count = 0
+
+    def pause_reading(self):
+        self.paused = True
+        self.pause_count += 1
+
+    def resume_reading(self):
+        self.paused = False
+        self.resume_count += 1
+
+
+async def upper(data, executor):
+    await asyncio.sleep(0)
+    return data.upper()
+
+
+def test_crypto_queue_keeps_order():
+    async def run():
+        out, errors = [], []
+        transport = FakeTransport()
+        q = CryptoQueue(
+            upper,
+            out.append,
+            errors.append,
+            transport.pause_reading,
+            transport.resume_reading,
+        )
+        for data in [b"a", b"b" * BIG, b"c", b"d" * BIG, b"e"]:
+            if not q.feed(memoryview(data)):
+                out.append(data.upper())
+        await asyncio.sleep(0.01)
+        # 队列排空之后小包又回到事件循环里直接处理
+        assert q.feed(b"f") is False
+        return out, errors
+
+    out, errors = asyncio.run(run())
+    assert [d[:1] for d in out] == [b"A", b"B", b"C", b"D", b"E"]
+    assert errors == []
+
+
+def test_crypto_queue_error_drops_pending():
+    async def broken(data, executor):
+        if data.startswith(b"x"):
+            raise ValueError("MAC check failed")
+        return data
+
+    async def run():
+        out, errors = [], []
+        transport = FakeTransport()
+        q = CryptoQueue(
+            broken,
+            out.append,
+            errors.append,
+            transport.pause_reading,
+            transport.resume_reading,
+        )
+        for data in [b"a" * BIG, b"x" * BIG, b"c"]:
+            q.feed(data)
+        await asyncio.sleep(0.01)
+        return out, errors
+
+    out, errors = asyncio.run(run())
+    assert [d[:1] for d in out] == [b"a"]
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+
+
+def test_crypto_queue_backpressure():
+    async def run():
+        release = asyncio.Event()
+
+        async def blocked(data, executor):
+            await release.wait()
+            return data
+
+        out = []
+        transport = FakeTransport()
+        q = CryptoQueue(
+            blocked,
+            out.append,
+            None,
+            transport.pause_reading,
+            transport.resume_reading,
+        )
+        n = core.CRYPTO_QUEUE_HIGH_WATER // BIG + 2
+        for _ in range(n):
+            q.feed(b"a" * BIG)
+        assert transport.paused and transport.pause_count == 1
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert not transport.paused
+        return len(out), n
+
+    got, expected = asyncio.run(run())
+    assert got == expected
+
+
+class FakeDatagramTransport:
+    def sendto(self, data, addr=None):
+        pass
+
+
+def test_local_udp_evicts_least_recent_peer(monkeypatch):
+    from shadowsocks.mdb.models import User
+
+    port = 18388
+    User.create(user_id=18388, port=port, method="none", password="udp-lru-test")
+    monkeypatch.setattr(core, "UDP_MAX_PEERS", 2)
+
+    local = core.LocalUDP(port)
+    local.connection_made(FakeDatagramTransport())
+    peers = [("127.0.0.1", 10000 + i) for i in range(3)]
+
+    local.datagram_received(b"", peers[0])
+    local.datagram_received(b"", peers[1])
+    first = local._protocols[peers[0]]
+    # 访问一次peer0, 让peer1变成最久没有活动的peer
+    local.datagram_received(b"", peers[0])
+    second = local._protocols[peers[1]]
+    local.datagram_received(b"", peers[2])
+
+    assert list(local._protocols) == [peers[0], peers[2]]
+    assert second._is_closing
+    assert not first._is_closing
+
+
+class FakeTCPTransport(FakeTransport):
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data.extend(data)
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 80)
+
+
+def _domain_header(domain, port):
+    return bytes((3, len(domain))) + domain + port.to_bytes(2, "big")
+
+
+def _make_tcp_handler(port, password):
+    from shadowsocks import protocol_flag as flag
+    from shadowsocks.mdb.models import User
+
+    User.create(user_id=port, port=port, method="none", password=password)
+    handler = core.LocalHandler(port)
+    local_transport = FakeTCPTransport()
+    handler.handle_connection_made(
+        flag.TRANSPORT_TCP, local_transport, ("127.0.0.1", 50000)
+    )
+    return handler, local_transport
+
+
+def test_data_during_dns_lookup_is_buffered(monkeypatch):
+    handler, local_transport = _make_tcp_handler(18389, "dns-race-test")
+    remote_transport = FakeTCPTransport()
+
+    async def slow_dns(domain):
+        await asyncio.sleep(0.05)
+        return "127.0.0.1"
+
+    monkeypatch.setattr(core, "get_ip_from_domain", slow_dns)
+
+    async def run():
+        async def create_connection(factory, host, port):
+            protocol = factory()
+            protocol.connection_made(remote_transport)
+            return remote_transport, protocol
+
+        asyncio.get_running_loop().create_connection = create_connection
+        handler.handle_data_received(_domain_header(b"example.com", 80) + b"GET / ")
+        await asyncio.sleep(0)
+        # dns还没有返回, 这时候的数据是stream数据而不是新的header
+        handler.handle_data_received(b"HTTP/1.1\r\n")
+        assert handler._stage == handler.STAGE_CONNECT
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert not handler._is_closing
+    assert handler._stage == handler.STAGE_CONNECT
+    assert bytes(remote_transport.data) == b"GET / HTTP/1.1\r\n"
+
+
+def test_closed_during_dns_lookup_skips_connect(monkeypatch):
+    handler, local_transport = _make_tcp_handler(18390, "dns-close-test")
+    connects = []
+
+    async def slow_dns(domain):
+        await asyncio.sleep(0.05)
+        return "127.0.0.1"
+
+    monkeypatch.setattr(core, "get_ip_from_domain", slow_dns)
+
+    async def run():
+        async def create_connection(factory, host, port):
+            connects.append((host, port))
+
+        asyncio.get_running_loop().create_connection = create_connection
+        handler.handle_data_received(_domain_header(b"example.com", 80))
+        await asyncio.sleep(0)
+        handler.close()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert connects == []
+
+
+def test_preconnect_cap_closes_and_drops_remote(monkeypatch):
+    handler, local_transport = _make_tcp_handler(18391, "preconnect-cap-test")
+    monkeypatch.setattr(core, "MAX_PRECONNECT_BYTES", 1024)
+    remote_transport = FakeTCPTransport()
+
+    async def run():
+        connected = asyncio.Event()
+
+        async def create_connection(factory, host, port):
+            await connected.wait()
+            protocol = factory()
+            protocol.connection_made(remote_transport)
+            return remote_transport, protocol
+
+        asyncio.get_running_loop().create_connection = create_connection
+        header = bytes((1, 127, 0, 0, 1)) + (80).to_bytes(2, "big")
+        handler.handle_data_received(header + b"a" * 512)
+        await asyncio.sleep(0)
+        handler.handle_data_received(b"b" * 512)
+        assert not handler._is_closing
+        handler.handle_data_received(b"c")
+        assert handler._is_closing
+        assert local_transport.closed
+
+        connected.set()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert handler._connect_buffer is None
+    assert remote_transport.closed
+    assert remote_transport.data == b""
+
+
+class FakeUDPTransport:
+    def __init__(self, peername):
+        self.peername = peername
+        self.sent = []
+
+    def get_extra_info(self, name):
+        return self.peername
+
+    def sendto(self, data, addr=None):
+        self.sent.append(data)
+
+
+def test_remote_udp_reply_header():
+    local = types.SimpleNamespace(cipher=None)
+
+    remote = core.RemoteUDP("1.2.3.4", 53, b"q", local)
+    remote.connection_made(FakeUDPTransport(("1.2.3.4", 53)))
+    assert remote._reply_hdr == b"\x01" + bytes((1, 2, 3, 4)) + b"\x00\x35"
+
+    remote = core.RemoteUDP("2001:db8::1", 53, b"q", local)
+    remote.connection_made(FakeUDPTransport(("2001:db8::1", 53, 0, 0)))
+    addr = socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+    assert remote._reply_hdr == b"\x04" + addr + b"\x00\x35"
+    assert len(remote._reply_hdr) == 1 + 16 + 2
+
+
+def test_crypto_queue_close_stops_drain():
+    async def run():
+        release = asyncio.Event()
+        calls, out = [], []
+
+        async def blocked(data, executor):
+            calls.append(data)
+            await release.wait()
+            return data
+
+        transport = FakeTransport()
+        q = CryptoQueue(
+            blocked, out.append, None, transport.pause_reading, transport.resume_reading
+        )
+        n = core.CRYPTO_QUEUE_HIGH_WATER // BIG + 2
+        for _ in range(n):
+            q.feed(b"a" * BIG)
+        await asyncio.sleep(0)
+        q.close()
+        # 关闭之后的数据直接丢掉
+        assert q.feed(b"b" * BIG) is True
+        release.set()
+        await asyncio.sleep(0.01)
+        return calls, out, transport
+
+    calls, out, transport = asyncio.run(run())
+    assert len(calls) == 1
+    assert out == []
+    assert transport.resume_count == 0
+
+
+def _make_remote_tcp(port, password):
+    handler, _ = _make_tcp_handler(port, password)
+    remote = core.RemoteTCP(handler)
+    remote_transport = FakeTCPTransport()
+    remote.connection_made(remote_transport)
+    return remote, remote_transport
+
+
+def _fill_encrypt_queue(remote, crypto_func):
+    remote._encrypt_queue._crypto_func = crypto_func
+    for _ in range(core.CRYPTO_QUEUE_HIGH_WATER // BIG + 2):
+        remote._encrypt_queue.feed(b"a" * BIG)
+
+
+def test_queue_drain_keeps_downstream_pause():
+    remote, remote_transport = _make_remote_tcp(18392, "queue-downstream-test")
+
+    async def run():
+        release = asyncio.Event()
+
+        async def blocked(data, executor):
+            await release.wait()
+            return data
+
+        _fill_encrypt_queue(remote, blocked)
+        assert remote_transport.paused
+        # local的写缓冲也满了
+        remote.pause_reading_for_downstream()
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert remote_transport.paused
+
+        remote.resume_reading_for_downstream()
+        assert not remote_transport.paused
+
+    asyncio.run(run())
+
+
+def test_downstream_resume_keeps_queue_pause():
+    remote, remote_transport = _make_remote_tcp(18393, "downstream-queue-test")
+
+    async def run():
+        release = asyncio.Event()
+
+        async def blocked(data, executor):
+            await release.wait()
+            return data
+
+        _fill_encrypt_queue(remote, blocked)
+        remote.pause_reading_for_downstream()
+        remote.resume_reading_for_downstream()
+        # 队列还在积压, 不能恢复读
+        assert remote_transport.paused
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert not remote_transport.paused
+
+    asyncio.run(run())
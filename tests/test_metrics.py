@@ -0,0 +1,20 @@
+from shadowsocks.metrics import ACTIVE_CONNECTION_COUNT, flush_batched_metrics
+
+
+def test_batched_metric_flush():
+    flush_batched_metrics()
+    gauge = ACTIVE_CONNECTION_COUNT._metric
+    before = gauge._value.get()
+
+    ACTIVE_CONNECTION_COUNT.inc()
+    ACTIVE_CONNECTION_COUNT.inc(3)
+    ACTIVE_CONNECTION_COUNT.inc(-1)
+    # flush之前不会写到prometheus
+    assert gauge._value.get() == before
+
+    flush_batched_metrics()
+    assert gauge._value.get() == before + 3
+    assert ACTIVE_CONNECTION_COUNT._delta == 0
+
+    flush_batched_metrics()
+    assert gauge._value.get() == before + 3
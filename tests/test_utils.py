@@ -0,0 +1,59 @@
+import asyncio
+
+from shadowsocks import utils
+
+
+def _fake_getaddrinfo(calls):
+    async def getaddrinfo(host, port, **kw):
+        calls.append(host)
+        return [(None, None, None, "", (f"10.0.0.{len(calls)}", 0))]
+
+    return getaddrinfo
+
+
+def test_dns_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(utils, "_dns_cache", utils.OrderedDict())
+
+    async def run():
+        calls = []
+        asyncio.get_running_loop().getaddrinfo = _fake_getaddrinfo(calls)
+        first = await utils.get_ip_from_domain("example.com")
+        cached = await utils.get_ip_from_domain("example.com")
+        now[0] += utils.DNS_CACHE_TTL + 1
+        expired = await utils.get_ip_from_domain("example.com")
+        return calls, first, cached, expired
+
+    calls, first, cached, expired = asyncio.run(run())
+    assert calls == ["example.com", "example.com"]
+    assert first == cached == "10.0.0.1"
+    assert expired == "10.0.0.2"
+
+
+def test_dns_cache_size_limit(monkeypatch):
+    monkeypatch.setattr(utils, "DNS_CACHE_SIZE", 2)
+    monkeypatch.setattr(utils, "_dns_cache", utils.OrderedDict())
+
+    async def run():
+        calls = []
+        asyncio.get_running_loop().getaddrinfo = _fake_getaddrinfo(calls)
+        for domain in ["a.com", "b.com", "c.com"]:
+            await utils.get_ip_from_domain(domain)
+
+    asyncio.run(run())
+    assert list(utils._dns_cache) == ["b.com", "c.com"]
+
+
+def test_dns_query_failed_returns_domain(monkeypatch):
+    monkeypatch.setattr(utils, "_dns_cache", utils.OrderedDict())
+
+    async def run():
+        async def getaddrinfo(host, port, **kw):
+            raise OSError("no such host")
+
+        asyncio.get_running_loop().getaddrinfo = getaddrinfo
+        return await utils.get_ip_from_domain("nonexistent.invalid")
+
+    assert asyncio.run(run()) == "nonexistent.invalid"
+    assert "nonexistent.invalid" not in utils._dns_cache